@@ -1,7 +1,8 @@
-import io
+import functools
 import math
 import os
 import random
+import shutil
 import time
 from typing import Dict, Optional, Tuple
 
@@ -10,7 +11,25 @@ import numpy as np
 import pandas as pd
 import requests
 import soundfile as sf
+from joblib import Memory
 from pydub import AudioSegment
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:  # Optional SIMD RMS kernels; numpy-rms<0.5 with numpy 1.x (0.5+ requires numpy>=2)
+    import numpy_rms
+
+    _HAS_NUMPY_RMS = True
+except ImportError:
+    _HAS_NUMPY_RMS = False
+
+
+# One pooled session for all downloads so keep-alive connections are reused
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.5)),
+)
 
 
 def ensure_dir(path: str) -> None:
@@ -19,55 +38,138 @@ def ensure_dir(path: str) -> None:
 
 def download_audio_to_wav(url: str, target_wav_path: str) -> str:
     """Download audio from URL and save as WAV. Returns saved path."""
-    resp = requests.get(url, timeout=300)
-    resp.raise_for_status()
-    # Try load with pydub to handle various formats, then export to WAV
-    audio = AudioSegment.from_file(io.BytesIO(resp.content))
-    audio.export(target_wav_path, format="wav")
+    tmp_path = target_wav_path + ".part"
+    try:
+        # Stream to disk instead of buffering the whole response in memory
+        with _SESSION.get(url, stream=True, timeout=300) as resp:
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(resp.raw, f)
+
+        with open(tmp_path, "rb") as f:
+            header = f.read(4)
+    except BaseException:
+        # Never leave a partial download behind
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if header == b"RIFF":
+        # Already WAV, no need to re-encode
+        os.replace(tmp_path, target_wav_path)
+        return target_wav_path
+
+    try:
+        # Decode in-process (libsndfile handles MP3/FLAC/OGG)
+        data, sr = sf.read(tmp_path)
+        sf.write(target_wav_path, data, sr, subtype="PCM_16")
+    except RuntimeError:
+        # Fall back to pydub/ffmpeg for formats libsndfile cannot read
+        audio = AudioSegment.from_file(tmp_path)
+        audio.export(target_wav_path, format="wav")
+    finally:
+        os.remove(tmp_path)
     return target_wav_path
 
 
-def load_audio_for_features(path: str, sr: int = 22050) -> Tuple[np.ndarray, int]:
-    y, _sr = librosa.load(path, sr=sr, mono=True)
-    return y, sr
+FEATURE_SR = 22050
 
+# Columns returned by compute_audio_features, in CSV order
+FEATURE_NAMES = (
+    "duration_seconds",
+    "tempo_bpm",
+    "rms_mean",
+    "spectral_centroid_mean",
+    "zero_crossing_rate_mean",
+    "mfcc1_mean",
+)
+
+# Part of the feature cache key: bump whenever feature extraction changes
+# (compute_audio_features or its helpers) so stale cached results are ignored
+FEATURE_VERSION = 1
+
+
+def load_mono(path: str, block_frames: int = 65536) -> Tuple[np.ndarray, int]:
+    """Decode a file once into a mono float32 array at its native sample rate.
+
+    Multichannel files are read in blocks and downmixed into a preallocated
+    buffer, so the full interleaved signal is never held in memory.
+    """
+    with sf.SoundFile(path) as f:
+        sr = int(f.samplerate)
+        if f.channels == 1:
+            return f.read(dtype="float32"), sr
+        y = np.empty(f.frames, dtype=np.float32)
+        pos = 0
+        for block in f.blocks(blocksize=block_frames, dtype="float32"):
+            n = min(len(block), len(y) - pos)
+            np.mean(block[:n], axis=1, out=y[pos : pos + n])
+            pos += n
+    return y[:pos], sr
+
+
+@functools.lru_cache(maxsize=None)
+def _mel_basis(sr: int, n_fft: int, n_mels: int) -> np.ndarray:
+    """Mel filterbank, built once and reused for every track at this rate."""
+    return librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels)
+
+
+def _fast_rms_mean(y: np.ndarray, frame: int = 2048, hop: int = 512) -> float:
+    """Mean of framewise RMS, matching librosa.feature.rms(y=y) with center=True.
+
+    Frame energies come from a cumulative sum of squared samples, which avoids
+    librosa's framing and numba warmup.
+    """
+    y_pad = np.pad(y, frame // 2)
+    n_frames = 1 + (len(y_pad) - frame) // hop
+    csum = np.empty(len(y_pad) + 1, dtype=np.float64)
+    csum[0] = 0.0
+    np.square(y_pad, out=csum[1:])
+    np.cumsum(csum[1:], out=csum[1:])
+    starts = np.arange(n_frames) * hop
+    energy = np.maximum(csum[starts + frame] - csum[starts], 0.0)
+    return float(np.mean(np.sqrt(energy / frame)))
 
-def compute_audio_features(wav_path: str) -> Dict[str, float]:
-    y, sr = load_audio_for_features(wav_path)
-    if y.size == 0:
-        return {
-            "duration_seconds": 0.0,
-            "tempo_bpm": 0.0,
-            "rms_mean": 0.0,
-            "spectral_centroid_mean": 0.0,
-            "zero_crossing_rate_mean": 0.0,
-            "mfcc1_mean": 0.0,
-        }
 
+def compute_audio_features(y: np.ndarray, sr: int, res_type: str = "soxr_hq") -> Dict[str, float]:
+    # Duration is exact at the native rate
     duration_seconds = float(librosa.get_duration(y=y, sr=sr))
+    if sr != FEATURE_SR and y.size:
+        # Spectral/frame features (incl. ZCR, which is per sample) are defined at a
+        # fixed rate so values stay comparable across models
+        y = librosa.resample(y, orig_sr=sr, target_sr=FEATURE_SR, res_type=res_type)
+        sr = FEATURE_SR
+    if y.size == 0:
+        return dict.fromkeys(FEATURE_NAMES, 0.0)
 
-    # Tempo
+    # One STFT shared by centroid, MFCC and beat tracking
+    n_mels = 128
+    magnitude = np.abs(librosa.stft(y, n_fft=2048, hop_length=512))
+    log_mel = librosa.power_to_db(_mel_basis(sr, 2048, n_mels) @ magnitude**2)
+
+    # Tempo (beat_track's own onset envelope is computed from this same log-mel)
     try:
-        tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
+        onset_env = librosa.onset.onset_strength(S=log_mel, sr=sr, aggregate=np.median)
+        tempo, _ = librosa.beat.beat_track(onset_envelope=onset_env, sr=sr)
         tempo_bpm = float(tempo)
     except Exception:
         tempo_bpm = 0.0
 
     # RMS
-    rms = librosa.feature.rms(y=y)
-    rms_mean = float(np.mean(rms))
+    rms_mean = _fast_rms_mean(y)
 
     # Spectral centroid
-    spectral_centroid = librosa.feature.spectral_centroid(y=y, sr=sr)
+    spectral_centroid = librosa.feature.spectral_centroid(S=magnitude, sr=sr)
     spectral_centroid_mean = float(np.mean(spectral_centroid))
 
-    # Zero crossing rate
-    zcr = librosa.feature.zero_crossing_rate(y)
-    zero_crossing_rate_mean = float(np.mean(zcr))
+    # Zero crossing rate (global rate instead of framing via librosa)
+    signs = np.signbit(y)
+    zero_crossing_rate_mean = float(np.count_nonzero(signs[1:] != signs[:-1]) / max(1, len(y) - 1))
 
-    # MFCCs
-    mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=13)
-    mfcc1_mean = float(np.mean(mfcc[0]))
+    # First MFCC, same as librosa.feature.mfcc(y=y, sr=sr)[0] with a shared mel basis.
+    # With an orthonormal DCT-II, coefficient 0 is sum(log-mel) / sqrt(n_mels),
+    # so its mean is sqrt(n_mels) * mean(log-mel) and the DCT can be skipped.
+    mfcc1_mean = float(np.sqrt(n_mels) * np.mean(log_mel))
 
     return {
         "duration_seconds": duration_seconds,
@@ -79,72 +181,120 @@ def compute_audio_features(wav_path: str) -> Dict[str, float]:
     }
 
 
+def _audio_features_for_key(
+    path: str,
+    mtime: float,
+    size: int,
+    feature_version: int,
+    feature_sr: int,
+    res_type: str,
+    y: np.ndarray,
+    sr: int,
+) -> Dict[str, float]:
+    # feature_version/feature_sr only serve as cache key components
+    return compute_audio_features(y, sr, res_type=res_type)
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_audio_features():
+    """Disk-cached _audio_features_for_key, created on first use (not at import)."""
+    memory = Memory(os.path.join("outputs", ".cache"), verbose=0)
+    return memory.cache(_audio_features_for_key, ignore=["y", "sr"])
+
+
+def compute_audio_features_cached(
+    path: str, y: np.ndarray, sr: int, res_type: str = "soxr_hq"
+) -> Dict[str, float]:
+    """compute_audio_features for the decoded contents of path, cached on disk.
+
+    The cache key is (path, mtime, size, FEATURE_VERSION, FEATURE_SR, res_type),
+    so the signal itself is never hashed.
+    """
+    stat = os.stat(path)
+    return _cached_audio_features()(
+        path, stat.st_mtime, stat.st_size, FEATURE_VERSION, FEATURE_SR, res_type, y, sr
+    )
+
+
 def make_snippet(
-    source_wav: str,
+    y: np.ndarray,
+    sr: int,
     target_wav: str,
     snippet_ms: int = 15000,
     fade_ms: int = 500,
     method: str = "random",
     seed: Optional[int] = None,
 ) -> Tuple[str, str, float]:
-    """Create a snippet from source_wav, save to target_wav.
+    """Create a snippet from the mono signal y, save to target_wav.
 
     Returns (snippet_path, snippet_method, snippet_length_seconds).
     """
-    audio = AudioSegment.from_file(source_wav)
-    length_ms = len(audio)
+    snippet_samples = int(sr * (snippet_ms / 1000.0))
     rng = random.Random(seed)
 
     # If shorter than desired snippet, loop to reach length
-    if length_ms < snippet_ms:
-        loops = math.ceil(snippet_ms / max(1, length_ms))
-        audio = audio * loops
-        length_ms = len(audio)
+    audio = y
+    if len(audio) < snippet_samples:
+        loops = math.ceil(snippet_samples / max(1, len(audio)))
+        audio = np.tile(audio, loops)
+    length_ms = int(1000.0 * len(audio) / sr)
 
-    if method == "random":
-        max_start = max(0, length_ms - snippet_ms)
-        start_ms = rng.randint(0, max_start) if max_start > 0 else 0
-        snippet = audio[start_ms : start_ms + snippet_ms]
-    elif method == "highest_rms":
-        # Choose the window with highest RMS energy using librosa for analysis
-        start_ms = _find_highest_rms_window_ms(source_wav, snippet_ms)
+    if method == "highest_rms":
+        # Choose the window with highest RMS energy on the original signal
+        start_ms = _find_highest_rms_window_ms(y, sr, snippet_ms)
         start_ms = int(max(0, min(start_ms, max(0, length_ms - snippet_ms))))
-        snippet = audio[start_ms : start_ms + snippet_ms]
     else:
-        # Default fallback behaves like random
+        # "random" and any unknown method pick a random start
         max_start = max(0, length_ms - snippet_ms)
         start_ms = rng.randint(0, max_start) if max_start > 0 else 0
-        snippet = audio[start_ms : start_ms + snippet_ms]
+    start = int(sr * (start_ms / 1000.0))
+    snippet = audio[start : start + snippet_samples].copy()
 
     # Apply fades
-    snippet = snippet.fade_in(fade_ms).fade_out(fade_ms)
+    _apply_fades(snippet, sr, fade_ms)
 
     ensure_dir(os.path.dirname(target_wav))
-    snippet.export(target_wav, format="wav")
+    sf.write(target_wav, snippet, sr, subtype="PCM_16")
     return target_wav, method, snippet_ms / 1000.0
 
 
-def _find_highest_rms_window_ms(path: str, window_ms: int, sr: int = 22050) -> int:
+def _apply_fades(y: np.ndarray, sr: int, fade_ms: int) -> None:
+    """Apply linear fade-in and fade-out to y in place."""
+    n_fade = min(int(sr * (fade_ms / 1000.0)), len(y) // 2)
+    if n_fade <= 0:
+        return
+    ramp = np.linspace(0.0, 1.0, n_fade, dtype=y.dtype)
+    y[:n_fade] *= ramp
+    y[len(y) - n_fade :] *= ramp[::-1]
+
+
+def _find_highest_rms_window_ms(y: np.ndarray, sr: int, window_ms: int) -> int:
     """Return the start position (ms) of the highest-RMS window of given length.
 
-    Uses a hop of 50ms for efficiency.
+    Uses a hop of 50ms and a cumulative sum of squared samples, so every
+    window's energy is a single subtraction. If numpy-rms is installed and the
+    window is a whole number of hops, per-hop energies come from its SIMD kernel.
     """
-    y, _sr = librosa.load(path, sr=sr, mono=True)
     if y.size == 0:
         return 0
     window_samples = int(sr * (window_ms / 1000.0))
-    hop_samples = int(sr * 0.05)
+    hop_samples = max(1, int(sr * 0.05))
     if window_samples <= 0 or window_samples >= len(y):
         return 0
-    best_start = 0
-    best_rms = -1.0
-    for start in range(0, len(y) - window_samples + 1, hop_samples):
-        segment = y[start : start + window_samples]
-        # Root-mean-square energy
-        rms = float(np.sqrt(np.mean(segment**2))) if segment.size else 0.0
-        if rms > best_rms:
-            best_rms = rms
-            best_start = start
+    if _HAS_NUMPY_RMS and window_samples % hop_samples == 0:
+        # SIMD per-hop block RMS, then slide the window over whole blocks
+        block_rms = numpy_rms.rms(np.ascontiguousarray(y, dtype=np.float32), hop_samples)
+        block_csum = np.concatenate(([0.0], np.cumsum(np.square(block_rms, dtype=np.float64))))
+        window_blocks = window_samples // hop_samples
+        sums = block_csum[window_blocks:] - block_csum[: len(block_csum) - window_blocks]
+        return int(1000.0 * int(np.argmax(sums)) * hop_samples / sr)
+    # csum[i] holds the energy of y[:i]; sqrt is skipped since argmax is monotone.
+    # Square and accumulate in place so no temporary array is allocated.
+    csum = np.empty(len(y) + 1, dtype=np.float64)
+    csum[0] = 0.0
+    np.square(y, out=csum[1:])
+    np.cumsum(csum[1:], out=csum[1:])
+    starts = np.arange(0, len(y) - window_samples + 1, hop_samples)
+    sums = csum[starts + window_samples] - csum[starts]
+    best_start = int(starts[np.argmax(sums)])
     return int(1000.0 * best_start / sr)
-
-
@@ -1,22 +1,50 @@
 import argparse
+import asyncio
 import logging
 import os
 import time
 import uuid
-from typing import Any, Dict, List, Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
 
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
+from tenacity import (
+    Retrying,
+    before_sleep_log,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_fixed,
+    wait_random_exponential,
+)
 from tqdm import tqdm
 
 from .prompts import sample_prompts
 from .audio_utils import (
+    FEATURE_NAMES,
     ensure_dir,
     download_audio_to_wav,
-    compute_audio_features,
+    load_mono,
+    compute_audio_features_cached,
     make_snippet,
 )
 
+# Output CSV columns, in order
+SCHEMA: List[str] = [
+    "song_id",
+    "prompt",
+    "model",
+    "model_version",
+    "audio_path",
+    "generation_time_seconds",
+    "snippet_path",
+    "snippet_method",
+    "snippet_length",
+    *FEATURE_NAMES,
+]
+
 
 def setup_logging() -> None:
     logging.basicConfig(
@@ -32,74 +60,170 @@ def get_replicate_client():
     return replicate
 
 
-def run_model(
-    replicate_mod: Any,
-    model: str,
-    prompt: str,
-    retries: int = 3,
-    backoff: float = 2.0,
-) -> List[str]:
-    """Run the Replicate model and return a list of audio URLs."""
+class NoAudioOutputError(RuntimeError):
+    """Raised when a model run finishes without a usable audio URL."""
+
+
+def _retryable_errors() -> Tuple[Type[BaseException], ...]:
+    # Lazy imports: both come with the replicate client
+    import httpx
+    from replicate.exceptions import ReplicateError
+
+    return (ReplicateError, httpx.HTTPError, NoAudioOutputError)
+
+
+def _call_model(replicate_mod: Any, model_with_version: str, input_data: Dict[str, Any]) -> List[str]:
+    out = replicate_mod.run(model_with_version, input=input_data)
+
+    # Handle the output based on type
+    if isinstance(out, str):
+        return [out]
+    if isinstance(out, list):
+        # Filter to strings
+        return [x for x in out if isinstance(x, str)]
+    if isinstance(out, dict):
+        # Try common keys
+        for key in ["audio", "audio_url", "output", "url"]:
+            if key in out and isinstance(out[key], str):
+                return [out[key]]
+        # If dict contains list under 'audio' or 'output'
+        for key in ["audio", "output"]:
+            if key in out and isinstance(out[key], list):
+                return [x for x in out[key] if isinstance(x, str)]
+    # Handle Replicate output objects with .url() method
+    if hasattr(out, 'url') and callable(getattr(out, 'url')):
+        return [out.url()]
+    raise NoAudioOutputError("Model did not return a usable audio URL")
+
+
+def resolve_model(model: str) -> Tuple[str, Callable[[str], Dict[str, Any]]]:
+    """Resolve a model name once into (pinned_version, prompt_to_input_fn)."""
     # Use specific model input formats for known models
     if "lucataco/ace-step" in model:
-        # Map our prompt to 'tags' and reuse it as basic lyrics if none provided
-        input_data = {
-            "tags": prompt,
-            "lyrics": prompt,
-        }
         # If no version hash supplied, pin to provided version for consistency
         if ":" not in model:
             model_with_version = "lucataco/ace-step:280fc4f9ee507577f880a167f639c02622421d8fecf492454320311217b688f1"
         else:
             model_with_version = model
-    elif "meta/musicgen" in model or "musicgen" in model:
-        input_data = {
+        # Map our prompt to 'tags' and reuse it as basic lyrics if none provided
+        return model_with_version, lambda prompt: {
+            "tags": prompt,
+            "lyrics": prompt,
+        }
+    if "meta/musicgen" in model or "musicgen" in model:
+        model_with_version = "meta/musicgen:671ac645ce5e552cc63a54a2bbff63fcf798043055d2dac5fc9e36a837eedcfb"
+        return model_with_version, lambda prompt: {
             "prompt": prompt,
             "model_version": "stereo-large",
             "output_format": "mp3",
             "normalization_strategy": "peak"
         }
-        model_with_version = "meta/musicgen:671ac645ce5e552cc63a54a2bbff63fcf798043055d2dac5fc9e36a837eedcfb"
-    else:
-        # Fallback for other models - try common input formats
-        input_data = {"prompt": prompt}
-        model_with_version = model
-    
-    last_err: Optional[Exception] = None
-    for attempt in range(1, retries + 1):
-        try:
-            out = replicate_mod.run(model_with_version, input=input_data)
-            
-            # Handle the output based on type
-            if out is None:
-                continue
-            if isinstance(out, str):
-                return [out]
-            if isinstance(out, list):
-                # Filter to strings
-                return [x for x in out if isinstance(x, str)]
-            if isinstance(out, dict):
-                # Try common keys
-                for key in ["audio", "audio_url", "output", "url"]:
-                    if key in out and isinstance(out[key], str):
-                        return [out[key]]
-                # If dict contains list under 'audio' or 'output'
-                for key in ["audio", "output"]:
-                    if key in out and isinstance(out[key], list):
-                        return [x for x in out[key] if isinstance(x, str)]
-            # Handle Replicate output objects with .url() method
-            if hasattr(out, 'url') and callable(getattr(out, 'url')):
-                return [out.url()]
-                
-        except Exception as e:  # noqa: BLE001
-            last_err = e
-            logging.warning("Replicate call failed (attempt %d/%d): %s", attempt, retries, e)
-            time.sleep(backoff * attempt)
-            continue
-    
-    if last_err:
-        raise last_err
-    raise RuntimeError("Model did not return a usable audio URL")
+    # Fallback for other models - try common input formats
+    return model, lambda prompt: {"prompt": prompt}
+
+
+def run_model(
+    replicate_mod: Any,
+    model_with_version: str,
+    input_data: Dict[str, Any],
+    retries: int = 3,
+    backoff: float = 2.0,
+) -> List[str]:
+    """Run the Replicate model and return a list of audio URLs.
+
+    Replicate/HTTP errors and empty outputs are retried with jittered
+    exponential backoff; the last error is re-raised.
+    """
+    retrying = Retrying(
+        retry=retry_if_exception_type(_retryable_errors()),
+        # 1s floor plus jittered exponential backoff, capped at 30s
+        wait=wait_fixed(1) + wait_random_exponential(multiplier=backoff, max=29),
+        stop=stop_after_attempt(retries),
+        before_sleep=before_sleep_log(logging.getLogger(), logging.WARNING),
+        reraise=True,
+    )
+    return retrying(_call_model, replicate_mod, model_with_version, input_data)
+
+
+async def _generate_one(
+    replicate_mod: Any,
+    model_with_version: str,
+    input_data: Dict[str, Any],
+    audio_path: str,
+    sem: asyncio.Semaphore,
+) -> float:
+    """Generate and download a single track. Returns generation time in seconds."""
+    async with sem:
+        start = time.perf_counter()
+        urls = await asyncio.to_thread(run_model, replicate_mod, model_with_version, input_data)
+        gen_time = time.perf_counter() - start
+        if not urls:
+            raise RuntimeError("No audio URLs returned by the model")
+        # Save first URL
+        await asyncio.to_thread(download_audio_to_wav, urls[0], audio_path)
+    return gen_time
+
+
+async def generate_tracks(
+    replicate_mod: Any,
+    model_with_version: str,
+    input_builder: Callable[[str], Dict[str, Any]],
+    jobs: Dict[str, str],
+    concurrency: int = 8,
+) -> Dict[str, float]:
+    """Generate and download tracks concurrently.
+
+    `jobs` maps audio_path -> prompt. Returns audio_path -> generation time.
+    """
+    # The blocking Replicate/HTTP calls run in threads; size the pool to match
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    sem = asyncio.Semaphore(concurrency)
+    paths = list(jobs)
+    tasks = [
+        asyncio.create_task(_generate_one(replicate_mod, model_with_version, input_builder(jobs[path]), path, sem))
+        for path in paths
+    ]
+    bar = tqdm(total=len(tasks), desc="Generating tracks")
+    for task in tasks:
+        task.add_done_callback(lambda _task: bar.update(1))
+    try:
+        gen_times = await asyncio.gather(*tasks)
+    finally:
+        bar.close()
+    return dict(zip(paths, gen_times))
+
+
+def process_track(
+    audio_path: str,
+    snippet_path: str,
+    snippet_ms: int,
+    snippet_method: str,
+    seed: int,
+) -> Tuple[Dict[str, float], Tuple[str, str, float]]:
+    """Extract features and write the snippet for one track (runs in a worker process).
+
+    Returns (features, (snippet_path, snippet_method, snippet_length_seconds)).
+    """
+    # Decode once; features and snippet share the waveform
+    y, sr = load_mono(audio_path)
+    features = compute_audio_features_cached(audio_path, y, sr)
+    snippet = make_snippet(
+        y=y,
+        sr=sr,
+        target_wav=snippet_path,
+        snippet_ms=snippet_ms,
+        fade_ms=500,
+        method=snippet_method,
+        seed=seed,
+    )
+    return features, snippet
+
+
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be >= 1, got {value}")
+    return number
 
 
 def main():
@@ -116,6 +240,8 @@ def main():
         choices=["random", "highest_rms"],
         help="How to pick the 15s snippet",
     )
+    parser.add_argument("--concurrency", type=_positive_int, default=8, help="Parallel model calls/downloads")
+    parser.add_argument("--workers", type=_positive_int, default=None, help="Processes for features/snippets (default: CPU count)")
     args = parser.parse_args()
 
     load_dotenv()
@@ -134,8 +260,11 @@ def main():
     # Prompts
     prompts = sample_prompts(args.num_tracks, seed=args.seed)
 
-    # Prepare rows
-    rows: List[Dict[str, Any]] = []
+    # Prepare columns (filled in place; avoids record-wise DataFrame inference).
+    # Numeric features live in typed float arrays, so no per-column dtype inference is needed.
+    cols: Dict[str, Any] = {key: [None] * len(prompts) for key in SCHEMA}
+    for name in FEATURE_NAMES:
+        cols[name] = np.empty(len(prompts), dtype=np.float64)
 
     # Load existing CSV if present and not forcing
     existing: Optional[pd.DataFrame] = None
@@ -155,53 +284,58 @@ def main():
     except Exception:
         model_version = None
 
-    for idx, prompt in enumerate(tqdm(prompts, desc="Generating tracks")):
-        song_id = str(uuid.uuid4())
-        audio_filename = f"song_{idx+1:02d}.wav"
-        audio_path = os.path.join(audio_dir, audio_filename)
-
-        if existing is not None and (existing.get("audio_path") == audio_path).any():
+    audio_paths = [os.path.join(audio_dir, f"song_{idx+1:02d}.wav") for idx in range(len(prompts))]
+    gen_times: Dict[str, float] = {}
+    pending: Dict[str, str] = {}
+    # Index previous generation times once instead of scanning the frame per track
+    existing_gen_times: Dict[str, float] = {}
+    if existing is not None and "audio_path" in existing:
+        existing_gen_times = (
+            existing.drop_duplicates("audio_path").set_index("audio_path")["generation_time_seconds"].to_dict()
+        )
+    for audio_path, prompt in zip(audio_paths, prompts):
+        if audio_path in existing_gen_times:
             # Skip generation; we will still recompute features/snippet below
-            gen_time = float(existing.loc[existing["audio_path"] == audio_path, "generation_time_seconds"].iloc[0])
+            gen_times[audio_path] = float(existing_gen_times[audio_path])
         else:
-            start = time.perf_counter()
-            urls = run_model(replicate_mod, args.model, prompt)
-            gen_time = time.perf_counter() - start
-            if not urls:
-                raise RuntimeError("No audio URLs returned by the model")
-            # Save first URL
-            download_audio_to_wav(urls[0], audio_path)
-
-        # Features
-        features = compute_audio_features(audio_path)
-
-        # Snippet
-        snippet_filename = f"song_{idx+1:02d}_snippet.wav"
-        snippet_path = os.path.join(snippet_dir, snippet_filename)
-        spath, smethod, slen = make_snippet(
-            source_wav=audio_path,
-            target_wav=snippet_path,
-            snippet_ms=int(args.snippet_seconds * 1000),
-            fade_ms=500,
-            method=args.snippet_method,
-            seed=args.seed + idx,
+            pending[audio_path] = prompt
+
+    # Model calls and downloads are network-bound, so run them concurrently
+    if pending:
+        model_with_version, input_builder = resolve_model(args.model)
+        gen_times.update(
+            asyncio.run(
+                generate_tracks(replicate_mod, model_with_version, input_builder, pending, args.concurrency)
+            )
         )
 
-        row: Dict[str, Any] = {
-            "song_id": song_id,
-            "prompt": prompt,
-            "model": args.model,
-            "model_version": model_version or "",
-            "audio_path": audio_path,
-            "generation_time_seconds": round(gen_time, 3),
-            "snippet_path": spath,
-            "snippet_method": smethod,
-            "snippet_length": slen,
-        }
-        row.update(features)
-        rows.append(row)
+    # Decoding, features and snippets are CPU-bound, so spread tracks across processes
+    snippet_paths = [os.path.join(snippet_dir, f"song_{idx+1:02d}_snippet.wav") for idx in range(len(prompts))]
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        results = executor.map(
+            process_track,
+            audio_paths,
+            snippet_paths,
+            repeat(int(args.snippet_seconds * 1000)),
+            repeat(args.snippet_method),
+            [args.seed + idx for idx in range(len(prompts))],
+        )
+        tracks = list(tqdm(results, total=len(prompts), desc="Processing tracks"))
+
+    for idx, (audio_path, prompt, (features, (spath, smethod, slen))) in enumerate(zip(audio_paths, prompts, tracks)):
+        cols["song_id"][idx] = str(uuid.uuid4())
+        cols["prompt"][idx] = prompt
+        cols["model"][idx] = args.model
+        cols["model_version"][idx] = model_version or ""
+        cols["audio_path"][idx] = audio_path
+        cols["generation_time_seconds"][idx] = round(gen_times[audio_path], 3)
+        cols["snippet_path"][idx] = spath
+        cols["snippet_method"][idx] = smethod
+        cols["snippet_length"][idx] = slen
+        for name in FEATURE_NAMES:
+            cols[name][idx] = features[name]
 
-    df = pd.DataFrame(rows)
+    df = pd.DataFrame(cols, columns=SCHEMA)
     ensure_dir(os.path.dirname(csv_path))
     df.to_csv(csv_path, index=False)
     print(f"Wrote CSV to {csv_path}")
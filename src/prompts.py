@@ -37,10 +37,11 @@ PROMPT_POOL: List[str] = [
 
 
 def sample_prompts(num: int, seed: int = 42) -> List[str]:
-    random.seed(seed)
+    # Local generator: no global state, same sequence as seeding the module
+    rng = random.Random(seed)
     # If requesting more than pool size, sample with replacement for simplicity
     if num <= len(PROMPT_POOL):
-        return random.sample(PROMPT_POOL, num)
-    return [random.choice(PROMPT_POOL) for _ in range(num)]
+        return rng.sample(PROMPT_POOL, num)
+    return [rng.choice(PROMPT_POOL) for _ in range(num)]
 
 